@@ -1,7 +1,16 @@
 """FlakyGuard engine — flaky test detection, classification & quarantine."""
 import sqlite3
-import xml.etree.ElementTree as ET
+from contextlib import contextmanager
 from datetime import datetime
+from itertools import chain, groupby
+from operator import itemgetter
+
+try:
+    from lxml import etree as ET
+    _LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _LXML = False
 
 CAUSES = {
     "timing": ["timeout", "timed out", "sleep", "deadline", "async", "wait"],
@@ -13,91 +22,275 @@ CAUSES = {
     "float_precision": ["precision", "float", "decimal", "almost equal"],
 }
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Below this many values the numpy conversion costs more than it saves.
+_NUMPY_MIN = 512
+
+
+# Flattened (category, keyword) pairs for the substring fallback scan.
+_KEYWORDS = tuple((cat, kw) for cat, kws in CAUSES.items() for kw in kws)
+_ZERO_SCORES = dict.fromkeys(CAUSES, 0)
+
+
+def _build_matcher():
+    """Compile every CAUSES keyword into one Aho-Corasick automaton."""
+    if ahocorasick is None:
+        return None
+    matcher = ahocorasick.Automaton()
+    for cat, kws in CAUSES.items():
+        for kw in kws:
+            matcher.add_word(kw, (cat, kw))
+    matcher.make_automaton()
+    return matcher
+
+
+_MATCHER = _build_matcher()
+
+# Integer status code stored in runs.code; fail and error stay distinct.
+_STATUS_CODE = """CASE {} WHEN 'pass' THEN 0
+    WHEN 'fail' THEN 1 WHEN 'error' THEN 2 ELSE 3 END"""
+_INSERT = f"INSERT INTO runs VALUES(NULL,?1,?2,?3,?4,?5,?6,{_STATUS_CODE.format('?2')})"
+# Rows written by other tools may leave code NULL; derive it from status then.
+_CODE = f"COALESCE(code, {_STATUS_CODE.format('status')})"
+
 
 def init_db(path="flakyguard.db"):
-    """Initialize SQLite database with runs table."""
+    """Initialize SQLite database with runs table.
+
+    Uses WAL journaling with synchronous=NORMAL: safe for the single-writer
+    CLI, and commits no longer fsync twice. Readers on network filesystems
+    that cannot share WAL memory should point FLAKYGUARD_DB at local disk.
+    """
     conn = sqlite3.connect(path)
+    conn.executescript("""PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY; PRAGMA mmap_size=268435456;
+        PRAGMA cache_size=-65536;""")
     conn.execute("""CREATE TABLE IF NOT EXISTS runs(
         id INTEGER PRIMARY KEY, name TEXT, status TEXT,
-        duration REAL, error TEXT, run_id TEXT, ts TEXT)""")
+        duration REAL, error TEXT, run_id TEXT, ts TEXT, code INTEGER)""")
+    if "code" not in {col[1] for col in conn.execute("PRAGMA table_info(runs)")}:
+        # Databases created before the code column: add and backfill once.
+        conn.execute("ALTER TABLE runs ADD COLUMN code INTEGER")
+        conn.execute(f"UPDATE runs SET code = {_STATUS_CODE.format('status')}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_runs_name_ts ON runs(name, ts, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_runs_name_status ON runs(name, status)")
     conn.commit()
     return conn
 
 
-def ingest(db, xml_path, run_id=None):
-    """Parse JUnit XML and store test results."""
-    run_id = run_id or f"r-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
-    ts = datetime.now().isoformat()
-    n = 0
-    for tc in ET.parse(xml_path).iter("testcase"):
+def _testcases(xml_path):
+    """Yield <testcase> elements, freeing each once the caller is done."""
+    if _LXML:
+        for _, tc in ET.iterparse(xml_path, tag="testcase", huge_tree=True):
+            yield tc
+            tc.clear()
+            while tc.getprevious() is not None:
+                del tc.getparent()[0]
+        return
+    parents = []
+    for event, el in ET.iterparse(xml_path, events=("start", "end")):
+        if event == "start":
+            parents.append(el)
+            continue
+        parents.pop()
+        if el.tag == "testcase":
+            yield el
+            el.clear()
+            if parents:  # detach from its <testsuite> so memory stays O(one testcase)
+                parents[-1].remove(el)
+
+
+def _rows(xml_path, run_id, ts):
+    """Yield one runs-table tuple per <testcase> in a JUnit XML file."""
+    for tc in _testcases(xml_path):
         name = f"{tc.get('classname', '')}.{tc.get('name', '')}"
         dur = float(tc.get("time", 0))
         fail_el, err_el = tc.find("failure"), tc.find("error")
         status = "fail" if fail_el is not None else ("error" if err_el is not None else "pass")
         el = fail_el if fail_el is not None else err_el
         msg = (el.get("message", "") or el.text or "") if el is not None else ""
-        db.execute("INSERT INTO runs VALUES(NULL,?,?,?,?,?,?)",
-                   (name, status, dur, msg, run_id, ts))
-        n += 1
-    db.commit()
-    return n, run_id
+        yield (name, status, dur, msg, run_id, ts)
+
+
+def _new_run_id():
+    """Timestamp-based run identifier for ingests without an explicit one."""
+    return f"r-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+
 
+@contextmanager
+def _write_txn(db):
+    """Own a transaction, or nest in a savepoint inside the caller's open one.
+
+    A transaction we open is committed or rolled back here. Inside the
+    caller's transaction only our own writes are undone on error, and
+    nothing is committed on their behalf.
+    """
+    if not db.in_transaction:
+        db.execute("BEGIN")
+        with db:
+            yield
+        return
+    db.execute("SAVEPOINT ingest")
+    try:
+        yield
+    except BaseException:
+        db.execute("ROLLBACK TO ingest")
+        db.execute("RELEASE ingest")
+        raise
+    db.execute("RELEASE ingest")
+
+
+def ingest(db, xml_path, run_id=None):
+    """Stream-parse JUnit XML and store test results in one transaction."""
+    run_id = run_id or _new_run_id()
+    ts = datetime.now().isoformat()
+    with _write_txn(db):
+        n = db.executemany(_INSERT, _rows(xml_path, run_id, ts)).rowcount
     return n, run_id
 
 
+def ingest_many(db, paths):
+    """Stream many JUnit XML files into one transaction, one run per file."""
+    paths = list(paths)
+    prefix, ts = _new_run_id(), datetime.now().isoformat()
+    rows = chain.from_iterable(_rows(p, f"{prefix}-{i}", ts)
+                               for i, p in enumerate(paths, 1))
+    with _write_txn(db):
+        n = db.executemany(_INSERT, rows).rowcount
+    return len(paths), n
+
+
 def detect(db, min_runs=3, threshold=0.1):
     """Detect flaky tests by computing flip rate across runs."""
-    rows = db.execute("""SELECT name, COUNT(*),
-        SUM(CASE WHEN status!='pass' THEN 1 ELSE 0 END)
-        FROM runs GROUP BY name HAVING COUNT(*)>=?""", (min_runs,)).fetchall()
-    out = []
-    for name, total, fails in rows:
-        sts = [r[0] for r in db.execute(
-            "SELECT status FROM runs WHERE name=? ORDER BY ts, id", (name,))]
-        flips = sum(1 for i in range(1, len(sts)) if sts[i] != sts[i - 1])
-        rate = flips / max(len(sts) - 1, 1)
+    flaky = {}
+    for name, total, flips, fails in _flip_stats(db, min_runs):
+        rate = flips / max(total - 1, 1)
         if rate >= threshold:
-            out.append({"test": name, "flip_rate": round(rate, 3),
-                        "runs": total, "failures": fails,
-                        "root_cause": _classify(db, name)})
-    return out
-
-
-def _classify(db, name):
-    """Classify root cause from error messages and duration variance."""
-    msgs = [r[0].lower() for r in db.execute(
-        "SELECT error FROM runs WHERE name=? AND status!='pass' AND error!=''",
-        (name,))]
-    scores = {k: sum(kw in m for m in msgs for kw in vs)
-              for k, vs in CAUSES.items()}
-    durs = [r[0] for r in db.execute(
-        "SELECT duration FROM runs WHERE name=? AND status!='pass'", (name,))]
-    if len(durs) > 1 and max(durs) > 3 * max(min(durs), 0.001):
+            flaky[name] = {"test": name, "flip_rate": round(rate, 3),
+                           "runs": total, "failures": fails}
+    if not flaky:
+        return []
+    failed = {}
+    cur = db.execute("""SELECT name, error, duration, run_id
+        FROM runs WHERE status!='pass' ORDER BY name""")
+    for name, group in groupby(cur, key=itemgetter(0)):
+        if name in flaky:
+            failed[name] = list(group)
+    for name, r in flaky.items():
+        rows = failed.get(name, [])
+        msgs = [err.lower() for _, err, _, _ in rows if err]
+        r["root_cause"] = _classify(msgs, [dur for _, _, dur, _ in rows])
+        r["reruns"] = len({run_id for _, _, _, run_id in rows})
+    return list(flaky.values())
+
+
+def _flip_stats(db, min_runs):
+    """Yield (name, runs, flips, failures) for tests with at least min_runs."""
+    if np is not None:
+        yield from _flip_stats_np(db, min_runs)
+        return
+    cur = db.execute(f"SELECT name, {_CODE} FROM runs ORDER BY name, ts, id")
+    for name, group in groupby(cur, key=itemgetter(0)):
+        codes = [r[1] for r in group]
+        n = len(codes)
+        if n >= min_runs:
+            flips = sum(1 for i in range(1, n) if codes[i] != codes[i - 1])
+            yield name, n, flips, n - codes.count(0)
+
+
+def _flip_stats_np(db, min_runs):
+    """_flip_stats over one flat status-code array segmented per test."""
+    own_txn = not db.in_transaction
+    if own_txn:
+        db.execute("BEGIN")  # both reads must see the same snapshot
+    try:
+        groups = db.execute("SELECT name, COUNT(*) FROM runs GROUP BY name ORDER BY name").fetchall()
+        if not groups:
+            return
+        starts = np.zeros(len(groups), dtype=np.int64)
+        np.cumsum([n for _, n in groups[:-1]], out=starts[1:])
+        cur = db.execute(f"SELECT {_CODE} FROM runs ORDER BY name, ts, id")
+        codes = np.fromiter(map(itemgetter(0), cur), dtype=np.int8,
+                            count=int(starts[-1]) + groups[-1][1])
+    finally:
+        if own_txn:
+            db.commit()
+    changed = np.zeros(codes.size, dtype=np.int8)
+    np.not_equal(codes[1:], codes[:-1], out=changed[1:], casting="unsafe")
+    changed[starts] = 0  # a test's first run never counts as a flip
+    flips = np.add.reduceat(changed, starts, dtype=np.int64)
+    fails = np.add.reduceat((codes != 0).astype(np.int8), starts, dtype=np.int64)
+    for (name, n), f, x in zip(groups, flips.tolist(), fails.tolist()):
+        if n >= min_runs:
+            yield name, n, f, x
+
+
+def _classify(msgs, durs):
+    """Classify root cause from lowercased error messages and failure durations."""
+    scores = _ZERO_SCORES.copy()
+    if _MATCHER is not None:
+        for m in msgs:
+            for cat, _ in {hit for _, hit in _MATCHER.iter(m)}:
+                scores[cat] += 1
+    else:
+        for m in msgs:
+            for cat, kw in _KEYWORDS:
+                if kw in m:
+                    scores[cat] += 1
+    if _spread_out(durs):
         scores["timing"] += 2
     best = max(scores, key=scores.get)
     return best if scores[best] > 0 else "non_deterministic"
 
 
+def _spread_out(durs):
+    """True when the slowest failure took over 3x the fastest one."""
+    if len(durs) < 2:
+        return False
+    if np is not None and len(durs) >= _NUMPY_MIN:
+        a = np.fromiter(durs, dtype=np.float64, count=len(durs))
+        lo, hi = float(a.min()), float(a.max())
+    else:
+        lo, hi = min(durs), max(durs)
+    return hi > 3 * max(lo, 0.001)
+
+
 def add_costs(results, db, ci_rate=0.008, rerun_min=10):
     """Calculate CI cost wasted per flaky test."""
     for r in results:
-        reruns = db.execute(
-            "SELECT COUNT(DISTINCT run_id) FROM runs WHERE name=? AND status!='pass'",
-            (r["test"],)).fetchone()[0]
+        reruns = r.get("reruns")
+        if reruns is None:  # results not produced by detect()
+            reruns = db.execute(
+                "SELECT COUNT(DISTINCT run_id) FROM runs WHERE name=? AND status!='pass'",
+                (r["test"],)).fetchone()[0]
         r["cost_usd"] = round(reruns * rerun_min * ci_rate, 2)
         r["reruns"] = reruns
     return results
 
 
+_QUARANTINE_HEADER = "import pytest\n\nQUARANTINED = {\n"
+_QUARANTINE_FOOTER = """}
+
+
+def pytest_collection_modifyitems(items):
+    for item in items:
+        fqn = f"{item.module.__name__}.{item.name}"
+        if fqn in QUARANTINED:
+            item.add_marker(pytest.mark.skip(reason="FlakyGuard quarantine"))
+"""
+
+
 def quarantine_code(results):
     """Generate conftest.py code that skips quarantined tests."""
-    lines = ["import pytest\n\nQUARANTINED = {\n"]
-    for r in results:
-        lines.append(f'    "{r["test"]}",  # flip={r["flip_rate"]:.0%} {r["root_cause"]}\n')
-    lines.append("}\n\n\ndef pytest_collection_modifyitems(items):\n")
-    lines.append("    for item in items:\n")
-    lines.append('        fqn = f"{item.module.__name__}.{item.name}"\n')
-    lines.append("        if fqn in QUARANTINED:\n")
-    lines.append('            item.add_marker(pytest.mark.skip('
-                 'reason="FlakyGuard quarantine"))\n')
-    return "".join(lines)
+    body = "".join(f'    "{r["test"]}",  # flip={r["flip_rate"]:.0%} {r["root_cause"]}\n'
+                   for r in results)
+    return _QUARANTINE_HEADER + body + _QUARANTINE_FOOTER
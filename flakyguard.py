@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 """FlakyGuard CLI — Detect, quarantine & cost-attribute flaky tests."""
+import functools
+import glob
 import json
 import os
+from operator import itemgetter
 
 import click
 from rich.console import Console
@@ -9,10 +12,25 @@ from rich.table import Table
 
 import engine
 
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj, indent=2)
+
 console = Console()
 DB = os.environ.get("FLAKYGUARD_DB", "flakyguard.db")
 
 
+@functools.lru_cache(maxsize=1)
+def get_db():
+    """Return the process-wide connection, opening it on first use."""
+    return engine.init_db(DB)
+
+
 @click.group()
 @click.version_option("0.1.0")
 def cli():
@@ -25,15 +43,11 @@ def cli():
 def ingest(path, run_id):
     """Ingest JUnit XML test results — single file or batch directory."""
     if os.path.isdir(path):
-        import ingest as ingest_mod
         pattern = os.path.join(path, "**", "*.xml")
-        result = ingest_mod.ingest_reports(pattern, DB)
-        console.print(
-            f"[green]\u2713[/] Ingested {result['files_ingested']} files "
-            f"({result['tests_recorded']} tests, "
-            f"{result['files_skipped']} skipped as duplicates)")
+        files, n = engine.ingest_many(get_db(), sorted(glob.glob(pattern, recursive=True)))
+        console.print(f"[green]\u2713[/] Ingested {files} files ({n} tests)")
     else:
-        db = engine.init_db(DB)
+        db = get_db()
         n, rid = engine.ingest(db, path, run_id)
         console.print(f"[green]\u2713[/] Ingested {n} test results (run: {rid})")
 
@@ -46,7 +60,7 @@ def trends(days, output):
     import ingest as ingest_mod
     results = ingest_mod.analyze_trends(DB, window_days=days)
     if output == "json":
-        click.echo(json.dumps(results, indent=2))
+        click.echo(_dumps(results))
         return
     if not results:
         console.print("[green]\u2713 No trend data available.[/]")
@@ -75,11 +89,11 @@ def trends(days, output):
 @click.option("--output", type=click.Choice(["table", "json"]), default="table")
 def detect(min_runs, threshold, ci_cost, rerun_min, output):
     """Detect flaky tests with statistical flip-rate analysis."""
-    db = engine.init_db(DB)
+    db = get_db()
     results = engine.add_costs(
         engine.detect(db, min_runs, threshold), db, ci_cost, rerun_min)
     if output == "json":
-        click.echo(json.dumps(results, indent=2))
+        click.echo(_dumps(results))
         return
     if not results:
         console.print("[green]✓ No flaky tests detected![/]")
@@ -87,13 +101,13 @@ def detect(min_runs, threshold, ci_cost, rerun_min, output):
     tbl = Table(title="🛡️ FlakyGuard — Flaky Test Report")
     for col in ["Test", "Flip Rate", "Runs", "Fails", "Root Cause", "Cost"]:
         tbl.add_column(col)
-    total_cost = 0.0
-    for r in sorted(results, key=lambda x: -x["flip_rate"]):
+    results.sort(key=itemgetter("flip_rate"), reverse=True)
+    for r in results:
         c = "red" if r["flip_rate"] > 0.3 else "yellow"
         tbl.add_row(r["test"][-55:], f"[{c}]{r['flip_rate']:.0%}[/]",
                     str(r["runs"]), str(r["failures"]),
                     r["root_cause"], f"${r['cost_usd']:.2f}")
-        total_cost += r["cost_usd"]
+    total_cost = sum(map(itemgetter("cost_usd"), results))
     console.print(tbl)
     console.print(f"\n💰 Monthly CI waste: [bold red]${total_cost:.2f}[/]  "
                   f"| 🔥 {len(results)} flaky tests found")
@@ -104,7 +118,7 @@ def detect(min_runs, threshold, ci_cost, rerun_min, output):
 @click.option("--threshold", default=0.1)
 def quarantine(min_runs, threshold):
     """Generate conftest.py to auto-skip quarantined flaky tests."""
-    db = engine.init_db(DB)
+    db = get_db()
     results = engine.detect(db, min_runs, threshold)
     if not results:
         console.print("[green]No flaky tests to quarantine.[/]")
@@ -117,7 +131,7 @@ def quarantine(min_runs, threshold):
 @cli.command()
 def stats():
     """Show ingestion statistics."""
-    db = engine.init_db(DB)
+    db = get_db()
     total = db.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
     tests = db.execute("SELECT COUNT(DISTINCT name) FROM runs").fetchone()[0]
     runs = db.execute("SELECT COUNT(DISTINCT run_id) FROM runs").fetchone()[0]
@@ -1,6 +1,7 @@
 """Tests for FlakyGuard engine — flaky detection, classification & cost."""
-import os
-import tempfile
+import sqlite3
+import tracemalloc
+import xml.etree.ElementTree
 
 import pytest
 
@@ -21,35 +22,141 @@ JUNIT_FAIL = """<?xml version="1.0"?>
 </testsuite>"""
 
 
-def _tmpxml(content):
-    f = tempfile.NamedTemporaryFile(mode="w", suffix=".xml", delete=False)
-    f.write(content)
-    f.close()
-    return f.name
+@pytest.fixture(scope="session")
+def pass_xml(tmp_path_factory):
+    path = tmp_path_factory.mktemp("junit") / "pass.xml"
+    path.write_text(JUNIT_PASS)
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def fail_xml(tmp_path_factory):
+    path = tmp_path_factory.mktemp("junit") / "fail.xml"
+    path.write_text(JUNIT_FAIL)
+    return str(path)
+
+
+@pytest.fixture(params=["accelerated", "fallback"])
+def accel(request, monkeypatch):
+    """Run once with whatever optional accelerators are installed, once without."""
+    if request.param == "accelerated" and (
+            engine.np is None and engine._MATCHER is None and not engine._LXML):
+        pytest.skip("no optional accelerators installed")
+    if request.param == "fallback":
+        monkeypatch.setattr(engine, "np", None)
+        monkeypatch.setattr(engine, "_MATCHER", None)
+        monkeypatch.setattr(engine, "_LXML", False)
+        monkeypatch.setattr(engine, "ET", xml.etree.ElementTree)
+    return request.param
 
 
 @pytest.fixture()
-def db(tmp_path):
-    return engine.init_db(str(tmp_path / "test.db"))
+def db(accel):
+    return engine.init_db(":memory:")
 
 
-def test_ingest_parses_junit_xml(db):
-    path = _tmpxml(JUNIT_PASS)
-    n, rid = engine.ingest(db, path, "run-1")
-    os.unlink(path)
+def test_ingest_parses_junit_xml(db, pass_xml):
+    n, rid = engine.ingest(db, pass_xml, "run-1")
     assert n == 2
     rows = db.execute("SELECT * FROM runs").fetchall()
     assert len(rows) == 2
     assert all(r[2] == "pass" for r in rows)
 
 
-def test_detect_finds_flaky_by_flip_rate(db):
-    p, f = _tmpxml(JUNIT_PASS), _tmpxml(JUNIT_FAIL)
+def test_ingest_keeps_callers_pending_writes_on_bad_xml(db, pass_xml, tmp_path):
+    bad = tmp_path / "truncated.xml"
+    bad.write_text(JUNIT_PASS[:-40])
+    db.execute("""INSERT INTO runs(name, status, duration, error, run_id, ts)
+        VALUES('t.pending', 'pass', 0.1, '', 'r0', '0')""")
+    with pytest.raises(Exception):
+        engine.ingest(db, str(bad), "run-bad")
+    assert db.in_transaction
+    assert db.execute("SELECT name FROM runs").fetchall() == [("t.pending",)]
+    engine.ingest(db, pass_xml, "run-1")
+    assert db.in_transaction  # the caller still owns the commit
+    db.rollback()
+    assert db.execute("SELECT COUNT(*) FROM runs").fetchone()[0] == 0
+
+
+def test_ingest_accepts_text_nodes_over_10mb(db, tmp_path):
+    trace = "x" * (11 * 1024 * 1024)
+    path = tmp_path / "huge.xml"
+    path.write_text(JUNIT_FAIL.replace("AssertionError", trace))
+    n, _ = engine.ingest(db, str(path), "run-1")
+    assert n == 2
+    statuses = db.execute("SELECT status FROM runs ORDER BY id").fetchall()
+    assert statuses == [("fail",), ("pass",)]
+
+
+def test_ingest_streams_nested_testsuites(db, tmp_path):
+    case = '<testcase classname="suite{}" name="test_{}" time="0.01"/>'
+    path = tmp_path / "nested.xml"
+    path.write_text("<testsuites>" + "".join(
+        "<testsuite>" + "".join(case.format(s, i) for i in range(30_000)) + "</testsuite>"
+        for s in range(2)) + "</testsuites>")
+    tracemalloc.start()
+    try:
+        count = sum(1 for _ in engine._testcases(str(path)))
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert count == 60_000
+    assert peak < 1_000_000  # processed testcases are not kept alive
+    n, _ = engine.ingest(db, str(path), "run-1")
+    assert n == 60_000
+    assert db.execute("SELECT COUNT(DISTINCT name) FROM runs").fetchone()[0] == 60_000
+
+
+def test_ingest_many_streams_files_as_separate_runs(db, pass_xml, fail_xml):
+    files, n = engine.ingest_many(db, [pass_xml, fail_xml, pass_xml])
+    assert (files, n) == (3, 6)
+    assert db.execute("SELECT COUNT(DISTINCT run_id) FROM runs").fetchone()[0] == 3
+    flaky = engine.detect(db, min_runs=3, threshold=0.1)
+    assert [r["test"] for r in flaky] == ["test_math.test_add"]
+
+
+def test_init_db_creates_code_column_without_migration(tmp_path, monkeypatch):
+    statements = []
+    connect = sqlite3.connect
+
+    def traced_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(engine.sqlite3, "connect", traced_connect)
+    db = engine.init_db(str(tmp_path / "new.db"))
+    assert "code" in {col[1] for col in db.execute("PRAGMA table_info(runs)")}
+    assert not [s for s in statements if s.startswith(("ALTER", "UPDATE"))]
+
+
+def test_init_db_migrates_pre_code_schema(accel, tmp_path):
+    path = str(tmp_path / "old.db")
+    old = sqlite3.connect(path)
+    old.execute("""CREATE TABLE runs(
+        id INTEGER PRIMARY KEY, name TEXT, status TEXT,
+        duration REAL, error TEXT, run_id TEXT, ts TEXT)""")
+    old.executemany("INSERT INTO runs VALUES(NULL,?,?,0.1,'',?,?)",
+                    [("t.a", "pass", "r0", "1"), ("t.a", "fail", "r1", "2"),
+                     ("t.a", "error", "r2", "3")])
+    old.commit()
+    old.close()
+    db = engine.init_db(path)
+    codes = db.execute("SELECT code FROM runs ORDER BY id").fetchall()
+    assert codes == [(0,), (1,), (2,)]
+    # A writer that lists its columns explicitly leaves code NULL.
+    db.execute("""INSERT INTO runs(name, status, duration, error, run_id, ts)
+        VALUES('t.a', 'pass', 0.1, '', 'r3', '4')""")
+    db.commit()
+    (r,) = engine.detect(db, min_runs=3, threshold=0.1)
+    assert (r["runs"], r["failures"], r["flip_rate"]) == (4, 2, 1.0)
+
+
+def test_detect_finds_flaky_by_flip_rate(db, pass_xml, fail_xml):
+    p, f = pass_xml, fail_xml
     for i, xml in enumerate([p, f, p, f, p]):
         engine.ingest(db, xml, f"run-{i}")
     results = engine.detect(db, min_runs=3, threshold=0.1)
-    os.unlink(p)
-    os.unlink(f)
     flaky = [r for r in results if r["test"] == "test_math.test_add"]
     assert len(flaky) == 1
     assert flaky[0]["flip_rate"] >= 0.5
@@ -57,41 +164,49 @@ def test_detect_finds_flaky_by_flip_rate(db):
     assert len(stable) == 0
 
 
-def test_root_cause_classifies_timing(db):
-    f = _tmpxml(JUNIT_FAIL)
-    p = _tmpxml(JUNIT_PASS)
+def test_root_cause_classifies_timing(db, pass_xml, fail_xml):
     for i in range(4):
-        engine.ingest(db, f, f"fail-{i}")
-    engine.ingest(db, p, "pass-0")
+        engine.ingest(db, fail_xml, f"fail-{i}")
+    engine.ingest(db, pass_xml, "pass-0")
     results = engine.detect(db, min_runs=3, threshold=0.1)
-    os.unlink(f)
-    os.unlink(p)
     flaky = [r for r in results if "test_add" in r["test"]]
     assert len(flaky) == 1
     assert flaky[0]["root_cause"] == "timing"
 
 
-def test_cost_attribution_calculates_dollars(db):
-    p, f = _tmpxml(JUNIT_PASS), _tmpxml(JUNIT_FAIL)
+def test_classify_counts_each_keyword_once_per_message(accel):
+    # One "wait" ties three repeats of "deadlock"; ties go to the first category.
+    assert engine._classify(["deadlock deadlock deadlock; wait"], []) == "timing"
+    assert engine._classify(["race in thread pool"] * 3, [0.1, 0.1]) == "race_condition"
+    assert engine._classify(["assertion failed"], [0.1, 1.0]) == "timing"
+    assert engine._classify([], []) == "non_deterministic"
+
+
+def test_classify_duration_spread_on_long_histories(accel):
+    n = engine._NUMPY_MIN + 88
+    tight = [0.5 + 0.001 * (i % 10) for i in range(n)]
+    spread = tight[:-1] + [5.0]
+    assert engine._classify(["assertion failed"] * n, tight) == "non_deterministic"
+    assert engine._classify(["assertion failed"] * n, spread) == "timing"
+
+
+def test_cost_attribution_calculates_dollars(db, pass_xml, fail_xml):
+    p, f = pass_xml, fail_xml
     for i, xml in enumerate([p, f, p, f]):
         engine.ingest(db, xml, f"run-{i}")
     results = engine.detect(db, min_runs=3, threshold=0.1)
     results = engine.add_costs(results, db, ci_rate=0.01, rerun_min=10)
-    os.unlink(p)
-    os.unlink(f)
     assert len(results) >= 1
     assert all(r["cost_usd"] > 0 for r in results)
     assert all(r["reruns"] >= 1 for r in results)
 
 
-def test_quarantine_generates_valid_python(db):
-    p, f = _tmpxml(JUNIT_PASS), _tmpxml(JUNIT_FAIL)
+def test_quarantine_generates_valid_python(db, pass_xml, fail_xml):
+    p, f = pass_xml, fail_xml
     for i, xml in enumerate([p, f, p, f, p]):
         engine.ingest(db, xml, f"run-{i}")
     results = engine.detect(db, min_runs=3, threshold=0.1)
     code = engine.quarantine_code(results)
-    os.unlink(p)
-    os.unlink(f)
     assert "QUARANTINED" in code
     assert "pytest_collection_modifyitems" in code
     compile(code, "<quarantine>", "exec")